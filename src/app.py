@@ -4,10 +4,12 @@ from dotenv import load_dotenv
 import tempfile
 import shutil
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from document_processor import DocumentProcessor
 from vector_store import VectorStore
 from retriever import Retriever
+from reranker import Reranker
 from rag_pipeline import RAGPipeline
 
 # Load environment variables
@@ -25,7 +27,10 @@ def get_rag_system():
         return None, None, None
 
     vector_store = VectorStore(conn_str)
-    retriever = Retriever(vector_store)
+    # Cross-encoder reranking is opt-in: set RERANKER_MODEL (e.g. BAAI/bge-reranker-v2-m3)
+    reranker_model = os.getenv("RERANKER_MODEL")
+    reranker = Reranker(reranker_model) if reranker_model else None
+    retriever = Retriever(vector_store, reranker=reranker)
     pipeline = RAGPipeline(retriever)
     processor = DocumentProcessor()
     
@@ -47,45 +52,85 @@ with st.sidebar:
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            for idx, uploaded_file in enumerate(uploaded_files):
-                status_text.text(f"Processing {uploaded_file.name}...")
-                
-                # Save to temp file
+            # Same-name uploads would race each other's replace=True upserts and leave a mix of
+            # both files' chunks, so only the last upload of each name is indexed.
+            latest_uploads = {}
+            for uploaded_file in uploaded_files:
+                if uploaded_file.name in latest_uploads:
+                    st.warning(f"⚠️ {uploaded_file.name} was uploaded more than once; indexing the last copy")
+                latest_uploads[uploaded_file.name] = uploaded_file
+            
+            # Save uploads to temp files so the extractors can read them from disk.
+            tmp_paths = []
+            for uploaded_file in latest_uploads.values():
                 with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{uploaded_file.name}") as tmp:
                     tmp.write(uploaded_file.getvalue())
-                    tmp_path = tmp.name
-                
-                try:
-                    # Process
-                    status_text.text(f"Extracting text from {uploaded_file.name}...")
-                    chunks = processor.process_file(tmp_path)
-                    
-                    if not chunks:
-                        st.warning(f"⚠️ No content extracted from {uploaded_file.name}")
-                        continue
-                    
-                    # Fix metadata source to be original filename
-                    for chunk in chunks:
-                        chunk['metadata']['source'] = uploaded_file.name
-                    
-                    # Add to DB
-                    status_text.text(f"Generating embeddings for {uploaded_file.name} ({len(chunks)} chunks)...")
-                    vector_store.add_documents(chunks)
+                    tmp_paths.append((uploaded_file.name, tmp.name))
+            
+            def index_chunks(name, chunks):
+                # Fix metadata source (and the id derived from it) to be original filename
+                for chunk in chunks:
+                    chunk['metadata']['source'] = name
+                    chunk['id'] = f"{name}:{chunk['metadata']['chunk_index']}"
+                # Replace any earlier upload of this file instead of adding next to it
+                vector_store.add_documents(chunks, replace=True)
+                return len(chunks)
+            
+            def report_error(name, error):
+                st.error(f"❌ Error processing {name}: {str(error)}")
+                import traceback
+                with st.expander("Error details"):
+                    st.code("".join(traceback.format_exception(error)))
+            
+            # Extraction and embedding + inserts run in separate thread pools, so one file's
+            # embeddings are in flight while the next file is still being extracted.
+            # Threads rather than processes: Streamlit replaces __main__ with this script, so
+            # spawned workers would re-run the whole app; threads also share the loaded encoder.
+            done = 0
+            status_text.text(f"Extracting text from {len(tmp_paths)} file(s)...")
+            try:
+                with ThreadPoolExecutor(max_workers=min(len(tmp_paths), os.cpu_count() or 1)) as extract_pool, \
+                        ThreadPoolExecutor(max_workers=4) as index_pool:
+                    extract_futures = {
+                        extract_pool.submit(processor.process_file, path): name
+                        for name, path in tmp_paths
+                    }
+                    index_futures = {}
                     
-                    st.success(f"✅ Indexed {uploaded_file.name} ({len(chunks)} chunks)")
+                    for future in as_completed(extract_futures):
+                        name = extract_futures[future]
+                        try:
+                            chunks = future.result()
+                        except Exception as e:
+                            report_error(name, e)
+                            chunks = None
+                        
+                        if chunks:
+                            status_text.text(f"Generating embeddings for {name} ({len(chunks)} chunks)...")
+                            index_futures[index_pool.submit(index_chunks, name, chunks)] = name
+                            continue
+                        
+                        if chunks is not None:
+                            st.warning(f"⚠️ No content extracted from {name}")
+                        done += 1
+                        progress_bar.progress(done / len(tmp_paths))
                     
-                except Exception as e:
-                    st.error(f"❌ Error processing {uploaded_file.name}: {str(e)}")
-                    import traceback
-                    with st.expander("Error details"):
-                        st.code(traceback.format_exc())
-                finally:
-                    os.unlink(tmp_path)
-                
-                # Update progress
-                progress_bar.progress((idx + 1) / len(uploaded_files))
+                    for future in as_completed(index_futures):
+                        name = index_futures[future]
+                        try:
+                            st.success(f"✅ Indexed {name} ({future.result()} chunks)")
+                        except Exception as e:
+                            report_error(name, e)
+                        
+                        # Update progress
+                        done += 1
+                        progress_bar.progress(done / len(tmp_paths))
+            finally:
+                for _, path in tmp_paths:
+                    os.unlink(path)
             
             status_text.text("✅ All files processed!")
+            pipeline.retriever.clear_cache()
             st.rerun()
     
     st.divider()
@@ -98,6 +143,7 @@ with st.sidebar:
         col1.text(doc)
         if col2.button("🗑️", key=doc):
             vector_store.delete_document(doc)
+            pipeline.retriever.clear_cache()
             st.rerun()
 
 # Main Chat Interface
@@ -122,26 +168,26 @@ if prompt := st.chat_input("Ask a question about your documents..."):
 
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
-            result = pipeline.answer_query(prompt)
-            answer = result["answer"]
-            details = result["retrieval_details"]
-            
-            st.markdown(answer)
-            with st.expander("Retrieval Details"):
-                # Simplify details for display
-                display_details = []
-                for item in details:
-                    display_details.append({
-                        "source": item['primary']['metadata']['source'],
-                        "score": item['primary'].get('score'),
-                        "text": item['primary']['text'],
-                        "context_before": len(item['context']['before']),
-                        "context_after": len(item['context']['after'])
-                    })
-                st.json(display_details)
-            
-            st.session_state.messages.append({
-                "role": "assistant", 
-                "content": answer,
-                "details": display_details
-            })
+            stream, details = pipeline.answer_query_stream(prompt)
+        
+        # Render the answer as tokens arrive instead of waiting for the full response
+        answer = st.write_stream(stream)
+        
+        with st.expander("Retrieval Details"):
+            # Simplify details for display
+            display_details = []
+            for item in details:
+                display_details.append({
+                    "source": item['primary']['metadata']['source'],
+                    "score": item['primary'].get('score'),
+                    "text": item['primary']['text'],
+                    "context_before": len(item['context']['before']),
+                    "context_after": len(item['context']['after'])
+                })
+            st.json(display_details)
+        
+        st.session_state.messages.append({
+            "role": "assistant", 
+            "content": answer,
+            "details": display_details
+        })
@@ -1,12 +1,25 @@
 import os
-from typing import List, Dict, Any
-import hashlib
+from typing import List, Dict, Any, Iterable, Iterator
+from collections import deque
 from datetime import datetime
+from itertools import islice
 from pathlib import Path
 import pypdf
 import docx
+import tiktoken
 from bs4 import BeautifulSoup
 
+try:
+    # C-based parser, much faster than BeautifulSoup's pure-Python html.parser
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+# Loaded once at import (BPE merges + regex) so uploads don't pay for it. The encoder is
+# thread-safe; the upload handler extracts files in threads (not worker processes) so they
+# all reuse this instance instead of each rebuilding it.
+_ENCODER = tiktoken.get_encoding("cl100k_base")
+
 class DocumentProcessor:
     def __init__(self, chunk_size: int = 800, chunk_overlap: int = 100):
         self.chunk_size = chunk_size
@@ -21,33 +34,31 @@ class DocumentProcessor:
             raise FileNotFoundError(f"File not found: {file_path}")
 
         file_ext = file_path.suffix.lower()
-        content = ""
         
         try:
             if file_ext == '.pdf':
-                content = self._read_pdf(file_path)
+                pages = self._read_pdf(file_path)
             elif file_ext == '.docx':
-                content = self._read_docx(file_path)
+                pages = [self._read_docx(file_path)]
             elif file_ext in ['.txt', '.md']:
-                content = self._read_text(file_path)
+                pages = [self._read_text(file_path)]
             elif file_ext == '.html':
-                content = self._read_html(file_path)
+                pages = [self._read_html(file_path)]
             else:
                 raise ValueError(f"Unsupported file type: {file_ext}")
             
-            return self._chunk_content(content, file_path.name)
+            return self._chunk_stream(pages, file_path.name)
             
         except Exception as e:
             print(f"Error processing {file_path}: {e}")
             return []
 
-    def _read_pdf(self, path: Path) -> str:
-        text = ""
+    def _read_pdf(self, path: Path) -> Iterator[str]:
+        """Yield the text of each page so the whole document is never one big string."""
         with open(path, 'rb') as f:
             reader = pypdf.PdfReader(f)
             for page in reader.pages:
-                text += page.extract_text() + "\n\n"
-        return text
+                yield (page.extract_text() or "") + "\n\n"
 
     def _read_docx(self, path: Path) -> str:
         doc = docx.Document(path)
@@ -59,51 +70,55 @@ class DocumentProcessor:
 
     def _read_html(self, path: Path) -> str:
         with open(path, 'r', encoding='utf-8') as f:
+            if HTMLParser is not None:
+                tree = HTMLParser(f.read())
+                # Match BeautifulSoup's get_text(): no script/style contents, but keep the title
+                tree.strip_tags(["script", "style", "noscript", "template"])
+                if tree.body is None:
+                    return tree.root.text(separator='\n') if tree.root is not None else ""
+                title = tree.css_first("title")
+                body_text = tree.body.text(separator='\n')
+                return f"{title.text()}\n{body_text}" if title is not None else body_text
             soup = BeautifulSoup(f, 'html.parser')
             return soup.get_text(separator='\n')
 
-    def _chunk_content(self, content: str, filename: str) -> List[Dict[str, Any]]:
+    def _chunk_stream(self, pages: Iterable[str], filename: str) -> List[Dict[str, Any]]:
         """
-        Split content into chunks with overlap.
+        Split a stream of text pieces (e.g. pages) into chunks with overlap.
+        Only a rolling window of tokens is kept, never the whole document's tokens.
         """
-        # Simple token estimation (approx 4 chars per token)
-        # For production, use tiktoken, but simple split is okay for now or we can use tiktoken if installed.
-        
-        # Let's use a simple character-based splitter for robustness first, 
-        # but since we have tiktoken in requirements, let's use it for better accuracy.
-        import tiktoken
-        enc = tiktoken.get_encoding("cl100k_base")
-        tokens = enc.encode(content)
-        
+        step = self.chunk_size - self.chunk_overlap
+        processed_date = datetime.now().isoformat()
         chunks = []
-        total_tokens = len(tokens)
         
-        start = 0
-        chunk_index = 0
+        buffer = deque()
+        # Tokens at the front of the buffer that were already part of the last emitted chunk
+        carried = 0
         
-        while start < total_tokens:
-            end = min(start + self.chunk_size, total_tokens)
-            chunk_tokens = tokens[start:end]
-            chunk_text = enc.decode(chunk_tokens)
-            
-            # Create chunk ID
-            chunk_id = hashlib.md5(f"{filename}_{chunk_index}".encode()).hexdigest()
-            
+        def emit(chunk_tokens: List[int]):
+            chunk_index = len(chunks)
             chunks.append({
-                "id": chunk_id,
-                "text": chunk_text,
+                "id": f"{filename}:{chunk_index}",
+                "text": _ENCODER.decode(chunk_tokens),
                 "metadata": {
                     "source": filename,
                     "chunk_index": chunk_index,
-                    "processed_date": datetime.now().isoformat(),
+                    "processed_date": processed_date,
                     "token_count": len(chunk_tokens)
                 }
             })
+        
+        for page in pages:
+            buffer.extend(_ENCODER.encode_ordinary(page))
             
-            if end == total_tokens:
-                break
-                
-            start += (self.chunk_size - self.chunk_overlap)
-            chunk_index += 1
-            
+            while len(buffer) >= self.chunk_size:
+                emit(list(islice(buffer, 0, self.chunk_size)))
+                for _ in range(step):
+                    buffer.popleft()
+                carried = self.chunk_overlap
+        
+        # Final partial chunk, unless everything left was already covered by the overlap
+        if len(buffer) > carried:
+            emit(list(buffer))
+        
         return chunks
@@ -1,5 +1,5 @@
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Tuple
 from openai import OpenAI
 from retriever import Retriever
 
@@ -15,10 +15,44 @@ class RAGPipeline:
         # 1. Retrieve
         retrieval_results = self.retriever.retrieve(query)
         
-        # 2. Format Context
+        # 2. Generate Answer
+        response = self.client.chat.completions.create(
+            model="gpt-4o",
+            messages=self._build_messages(query, retrieval_results),
+            temperature=0.3
+        )
+        
+        answer = response.choices[0].message.content
+        
+        return {
+            "answer": answer,
+            "retrieval_details": retrieval_results
+        }
+
+    def answer_query_stream(self, query: str) -> Tuple[Iterator[str], List[Dict[str, Any]]]:
+        """
+        Same as answer_query, but the answer is returned as a generator of text
+        fragments (for st.write_stream) alongside the retrieval details.
+        """
+        retrieval_results = self.retriever.retrieve(query)
+        
+        stream = self.client.chat.completions.create(
+            model="gpt-4o",
+            messages=self._build_messages(query, retrieval_results),
+            temperature=0.3,
+            stream=True
+        )
+        
+        def tokens() -> Iterator[str]:
+            for chunk in stream:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""
+        
+        return tokens(), retrieval_results
+
+    def _build_messages(self, query: str, retrieval_results: List[Dict[str, Any]]) -> List[Dict[str, str]]:
         context_text = self._format_context(retrieval_results)
         
-        # 3. Generate Answer
         system_prompt = """You are a helpful assistant for a RAG system. 
 Use the provided context to answer the user's question. 
 If the answer is not in the context, say you don't know.
@@ -30,23 +64,10 @@ IMPORTANT: When writing mathematical formulas or expressions, you MUST use LaTeX
 - Do NOT use other delimiters like \( \) or \[ \].
 """
         
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"Context:\n{context_text}\n\nQuestion: {query}"}
         ]
-        
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.3
-        )
-        
-        answer = response.choices[0].message.content
-        
-        return {
-            "answer": answer,
-            "retrieval_details": retrieval_results
-        }
 
     def _format_context(self, results: List[Dict[str, Any]]) -> str:
         formatted = []
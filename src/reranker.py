@@ -0,0 +1,40 @@
+import re
+from typing import List, Dict, Any
+from ttl_cache import TTLCache
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+# Quoted phrases and bare filenames are literal lookups; reranking them adds latency without helping.
+_QUOTED = re.compile(r'^\s*(["\']).+\1\s*$')
+_FILENAME = re.compile(r'^\s*[\w\-.]+\.(pdf|docx|txt|md|html)\s*$', re.IGNORECASE)
+
+
+def is_literal_lookup(query: str) -> bool:
+    return bool(_QUOTED.match(query) or _FILENAME.match(query))
+
+
+class Reranker:
+    """Cross-encoder that rescores (query, chunk) pairs, with cached scores."""
+
+    def __init__(self, model_name: str = "BAAI/bge-reranker-v2-m3", cache_size: int = 4096, cache_ttl: float = 900):
+        if CrossEncoder is None:
+            raise ImportError("Reranking requires sentence-transformers: pip install sentence-transformers")
+        # CrossEncoder runs on the GPU when one is available
+        self.model = CrossEncoder(model_name)
+        self.cache = TTLCache(max_items=cache_size, ttl=cache_ttl)
+
+    def score(self, query: str, chunks: List[Dict[str, Any]]) -> List[float]:
+        """Score chunks against the query; uncached pairs are scored in one batched forward pass."""
+        scores = [self.cache.get((query, chunk['id'])) for chunk in chunks]
+        missing = [i for i, s in enumerate(scores) if s is None]
+
+        if missing:
+            new_scores = self.model.predict([(query, chunks[i]['text']) for i in missing])
+            for i, new_score in zip(missing, new_scores):
+                scores[i] = float(new_score)
+                self.cache.set((query, chunks[i]['id']), scores[i])
+
+        return scores
@@ -1,75 +1,147 @@
-import hashlib
-from typing import List, Dict, Any, Set
+import threading
+import time
+from typing import List, Dict, Any, Optional
+import numpy as np
 from vector_store import VectorStore
+from ttl_cache import TTLCache
+from reranker import Reranker, is_literal_lookup
+
+# Cosine similarity above which a new query reuses the results of a cached one.
+SEMANTIC_CACHE_THRESHOLD = 0.95
 
 class Retriever:
-    def __init__(self, vector_store: VectorStore):
+    def __init__(self, vector_store: VectorStore, reranker: Optional[Reranker] = None,
+                 rerank_candidates: int = 30, cache_size: int = 512, cache_ttl: float = 900):
         self.vector_store = vector_store
+        self.reranker = reranker
+        # Number of vector-search hits the reranker picks the final top_k from.
+        self.rerank_candidates = rerank_candidates
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # Exact cache keyed by normalized query text.
+        self.cache = TTLCache(max_items=cache_size, ttl=cache_ttl)
+        # Semantic cache: L2-normalized query embeddings (one row per entry, oldest first)
+        # and the matching (params, results, created_at) entries. The Retriever is shared by
+        # all Streamlit sessions, so the two are only read or replaced under the lock.
+        self._semantic_lock = threading.Lock()
+        self._cached_qvecs = np.empty((0, 0), dtype=np.float32)
+        self._cached_entries: List[Dict[str, Any]] = []
+
+    def clear_cache(self):
+        """Forget cached results, e.g. after documents were added or deleted."""
+        self.cache.clear()
+        if self.reranker is not None:
+            self.reranker.cache.clear()
+        with self._semantic_lock:
+            self._cached_qvecs = np.empty((0, 0), dtype=np.float32)
+            self._cached_entries = []
+
+    def _semantic_lookup(self, qvec: np.ndarray, params: tuple) -> Optional[List[Dict[str, Any]]]:
+        with self._semantic_lock:
+            if not self._cached_entries:
+                return None
+
+            # Drop expired entries
+            now = time.monotonic()
+            alive = [i for i, e in enumerate(self._cached_entries) if now - e['created_at'] < self.cache_ttl]
+            if len(alive) < len(self._cached_entries):
+                self._cached_qvecs = self._cached_qvecs[alive]
+                self._cached_entries = [self._cached_entries[i] for i in alive]
+                if not alive:
+                    return None
+
+            scores = self._cached_qvecs @ qvec
+            scores[[e['params'] != params for e in self._cached_entries]] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] <= SEMANTIC_CACHE_THRESHOLD:
+                return None
 
-    def _generate_chunk_id(self, filename: str, index: int) -> str:
-        return hashlib.md5(f"{filename}_{index}".encode()).hexdigest()
+            # Move the hit to the most recently used position
+            order = [i for i in range(len(self._cached_entries)) if i != best] + [best]
+            self._cached_qvecs = self._cached_qvecs[order]
+            self._cached_entries = [self._cached_entries[i] for i in order]
+            return self._cached_entries[-1]['results']
+
+    def _semantic_store(self, qvec: np.ndarray, params: tuple, results: List[Dict[str, Any]]):
+        with self._semantic_lock:
+            if self._cached_qvecs.size == 0:
+                self._cached_qvecs = qvec[np.newaxis, :]
+            else:
+                self._cached_qvecs = np.vstack([self._cached_qvecs, qvec])
+            self._cached_entries.append({"params": params, "results": results, "created_at": time.monotonic()})
+
+            # Evict least recently used
+            if len(self._cached_entries) > self.cache_size:
+                self._cached_qvecs = self._cached_qvecs[1:]
+                self._cached_entries = self._cached_entries[1:]
 
     def retrieve(self, query: str, top_k: int = 5, adjacency_window: int = 1) -> Dict[str, Any]:
         """
         Retrieve chunks and their context.
         Returns a dict with 'primary_chunks' and 'context_chunks'.
         """
-        # 1. Get primary chunks
-        primary_chunks = self.vector_store.query(query, limit=top_k)
-        
-        # 2. Identify adjacent IDs
-        adjacent_ids: Set[str] = set()
+        # 0. Serve repeated or near-identical queries from cache
+        params = (top_k, adjacency_window)
+        cache_key = (" ".join(query.lower().split()), params)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        query_embedding = self.vector_store.get_embedding(query)
+        qvec = np.asarray(query_embedding, dtype=np.float32)
+        qvec /= np.linalg.norm(qvec)
+
+        cached = self._semantic_lookup(qvec, params)
+        if cached is not None:
+            self.cache.set(cache_key, cached)
+            return cached
+
+        # 1. Get primary chunks and their neighbours in one query
+        rerank = self.reranker is not None and not is_literal_lookup(query)
+        primary_chunks, context_chunks = self.vector_store.query_with_context(
+            query,
+            limit=max(top_k, self.rerank_candidates) if rerank else top_k,
+            adjacency_window=adjacency_window,
+            query_embedding=query_embedding
+        )
         
-        for chunk in primary_chunks:
-            filename = chunk['metadata']['source']
-            current_index = chunk['metadata']['chunk_index']
+        # 1b. Rerank the candidates with the cross-encoder and keep the best top_k
+        if rerank and primary_chunks:
+            for chunk, rerank_score in zip(primary_chunks, self.reranker.score(query, primary_chunks)):
+                chunk['rerank_score'] = rerank_score
+            primary_chunks.sort(key=lambda x: x['rerank_score'], reverse=True)
+            kept, dropped = primary_chunks[:top_k], primary_chunks[top_k:]
+            kept_ids = {c['id'] for c in kept}
+            context_chunks = [c for c in context_chunks if c['neighbor_of'] in kept_ids]
             
-            # Look before and after
-            for i in range(1, adjacency_window + 1):
-                prev_index = current_index - i
-                next_index = current_index + i
-                
-                if prev_index >= 0:
-                    adjacent_ids.add(self._generate_chunk_id(filename, prev_index))
-                
-                # We don't know the max index easily, but querying a non-existent ID just returns nothing, which is fine.
-                adjacent_ids.add(self._generate_chunk_id(filename, next_index))
-        
-        # Filter out IDs that are already in primary chunks to avoid duplicates in fetching
-        primary_ids = {c['id'] for c in primary_chunks}
-        ids_to_fetch = list(adjacent_ids - primary_ids)
-        
-        # 3. Fetch adjacent chunks
-        context_chunks = self.vector_store.get_chunks_by_ids(ids_to_fetch)
+            # Dropped candidates were excluded from the neighbour join, so re-attach
+            # the ones that sit next to a kept chunk.
+            for chunk in kept:
+                for other in dropped:
+                    if (other['metadata']['source'] == chunk['metadata']['source']
+                            and abs(other['metadata']['chunk_index'] - chunk['metadata']['chunk_index']) <= adjacency_window):
+                        context_chunks.append({
+                            "id": other['id'],
+                            "text": other['text'],
+                            "metadata": other['metadata'],
+                            "neighbor_of": chunk['id']
+                        })
+            primary_chunks = kept
         
-        # Map context chunks by ID for easy lookup
-        context_map = {c['id']: c for c in context_chunks}
+        # 2. Attach each neighbour to the primary chunk it was fetched for
+        contexts = {c['id']: {"before": [], "after": []} for c in primary_chunks}
+        indices = {c['id']: c['metadata']['chunk_index'] for c in primary_chunks}
         
-        # 4. Structure the result
-        # We want to attach context to the primary chunks if possible, or just return them as a pool.
-        # Let's return a structured response where each primary chunk has its specific context attached,
-        # but also provide a flat list for the LLM.
+        for ctx in context_chunks:
+            primary_id = ctx['neighbor_of']
+            side = "before" if ctx['metadata']['chunk_index'] < indices[primary_id] else "after"
+            contexts[primary_id][side].append(ctx)
         
+        # 3. Structure the result
         expanded_results = []
         
         for chunk in primary_chunks:
-            filename = chunk['metadata']['source']
-            current_index = chunk['metadata']['chunk_index']
-            
-            chunk_context = {
-                "before": [],
-                "after": []
-            }
-            
-            # Find specific context for this chunk
-            for i in range(1, adjacency_window + 1):
-                prev_id = self._generate_chunk_id(filename, current_index - i)
-                next_id = self._generate_chunk_id(filename, current_index + i)
-                
-                if prev_id in context_map:
-                    chunk_context["before"].append(context_map[prev_id])
-                if next_id in context_map:
-                    chunk_context["after"].append(context_map[next_id])
+            chunk_context = contexts[chunk['id']]
             
             # Sort context by index to ensure order
             chunk_context["before"].sort(key=lambda x: x['metadata']['chunk_index'])
@@ -79,5 +151,7 @@ class Retriever:
                 "primary": chunk,
                 "context": chunk_context
             })
-            
+
+        self.cache.set(cache_key, expanded_results)
+        self._semantic_store(qvec, params, expanded_results)
         return expanded_results
@@ -1,19 +1,111 @@
 import os
+import io
+import asyncio
 import json
-from typing import List, Dict, Any, Optional
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
 import psycopg2
-from psycopg2.extras import Json
-from openai import OpenAI
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from openai import OpenAI, AsyncOpenAI
+from ttl_cache import TTLCache
 import numpy as np
 
+# OpenAI accepts arrays of inputs per embeddings request; keep batches well under the limit.
+EMBEDDING_BATCH_SIZE = 96
+
+# Maximum embedding requests in flight at once.
+EMBEDDING_CONCURRENCY = 8
+
+# Smaller loads use multi-row INSERTs; creating a staging table isn't worth it for a few rows.
+COPY_THRESHOLD = 500
+
+UPSERT_SQL = """
+    INSERT INTO documents (id, content, metadata, embedding)
+    VALUES %s
+    ON CONFLICT (id) DO UPDATE 
+    SET content = EXCLUDED.content,
+        metadata = EXCLUDED.metadata,
+        embedding = EXCLUDED.embedding;
+"""
+
+# COPY cannot resolve conflicts itself, so bulk loads land in a per-transaction
+# staging table first and are merged into documents with a single upsert.
+STAGE_SQL = "CREATE TEMP TABLE documents_stage (LIKE documents) ON COMMIT DROP;"
+
+COPY_SQL = "COPY documents_stage (id, content, metadata, embedding) FROM STDIN WITH (FORMAT text)"
+
+MERGE_SQL = """
+    INSERT INTO documents (id, content, metadata, embedding)
+    SELECT id, content, metadata, embedding FROM documents_stage
+    ON CONFLICT (id) DO UPDATE 
+    SET content = EXCLUDED.content,
+        metadata = EXCLUDED.metadata,
+        embedding = EXCLUDED.embedding;
+"""
+
+HNSW_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS documents_embedding_hnsw
+    ON documents USING hnsw (embedding halfvec_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+"""
+
+DROP_HNSW_INDEX_SQL = "DROP INDEX IF EXISTS documents_embedding_hnsw;"
+
+# Loads at least this large, into a table that is empty or not much bigger than the load,
+# drop the HNSW index and rebuild it afterwards instead of inserting into the graph row by row.
+# For a small load into a large table a rebuild would re-index the whole corpus, so those
+# insert into the live index.
+INDEX_REBUILD_THRESHOLD = 2000
+INDEX_REBUILD_RATIO = 0.5
+
+
+def _vec_literal(v) -> str:
+    """
+    Serialize an embedding as pgvector's '[x,y,...]' text literal. json.dumps runs in C,
+    which is much faster than psycopg2 adapting a list of floats into ARRAY[...] syntax.
+    """
+    return json.dumps(v if isinstance(v, list) else v.tolist(), separators=(",", ":"))
+
+
+def _copy_escape(value: str) -> str:
+    """Escape a value for COPY's text format."""
+    return (value.replace("\\", "\\\\")
+                 .replace("\t", "\\t")
+                 .replace("\n", "\\n")
+                 .replace("\r", "\\r"))
+
+
 class VectorStore:
-    def __init__(self, connection_string: str):
+    def __init__(self, connection_string: str, ef_search: int = 40):
         self.conn_str = connection_string
+        self.ef_search = ef_search
         self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # Per-instance cache of query embeddings, keyed by normalized text. Embeddings never
+        # go stale, so the TTL only bounds how long a rarely used entry stays around.
+        self._embedding_cache = TTLCache(max_items=1024, ttl=24 * 3600)
+        # Session settings are passed as startup options so every pooled connection gets them.
+        self.pool = ThreadedConnectionPool(
+            minconn=1,
+            maxconn=8,
+            dsn=connection_string,
+            options=f"-c jit=off -c hnsw.ef_search={ef_search}"
+        )
         self._init_db()
 
+    @contextmanager
     def _get_conn(self):
-        return psycopg2.connect(self.conn_str)
+        """Borrow a pooled connection; the transaction is rolled back if the block raises."""
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        """Close all pooled connections."""
+        self.pool.closeall()
 
     def _init_db(self):
         """Initialize the database with vector extension and table."""
@@ -26,63 +118,165 @@ class VectorStore:
                             id TEXT PRIMARY KEY,
                             content TEXT,
                             metadata JSONB,
-                            embedding vector(3072)
+                            embedding halfvec(3072)
                         );
                     """)
-                    # Create index for faster retrieval
-                    # ivfflat is good for recall/speed balance, but requires some data to build effectively.
-                    # For simplicity and smaller datasets, exact search or HNSW (if available in newer pgvector) is fine.
-                    # Let's stick to basic table for now, add index later if needed.
+                    # Embeddings are stored as FP16 halfvec: half the bytes per row to scan, and
+                    # HNSW supports up to 4000 halfvec dimensions (vector is capped at 2000).
+                    # Tables created with the old vector(3072) column are converted in place.
+                    cur.execute("""
+                        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                        WHERE attrelid = 'documents'::regclass AND attname = 'embedding';
+                    """)
+                    if cur.fetchone()[0] != 'halfvec(3072)':
+                        cur.execute(DROP_HNSW_INDEX_SQL)
+                        cur.execute("""
+                            ALTER TABLE documents
+                            ALTER COLUMN embedding TYPE halfvec(3072) USING embedding::halfvec(3072);
+                        """)
+                    # Real columns for the adjacency/delete lookups so they don't extract JSON per row;
+                    # generated from metadata, so existing rows are backfilled automatically.
+                    cur.execute("""
+                        ALTER TABLE documents
+                        ADD COLUMN IF NOT EXISTS source TEXT
+                            GENERATED ALWAYS AS (metadata->>'source') STORED,
+                        ADD COLUMN IF NOT EXISTS chunk_index INT
+                            GENERATED ALWAYS AS ((metadata->>'chunk_index')::int) STORED;
+                    """)
+                    # Serves both source-only lookups (leading column) and (source, chunk_index) ranges.
+                    cur.execute("CREATE INDEX IF NOT EXISTS documents_source_idx ON documents (source, chunk_index);")
+                    # HNSW needs no training data (unlike ivfflat), so it can be created on an empty table.
+                    cur.execute(HNSW_INDEX_SQL)
                 conn.commit()
         except Exception as e:
             print(f"Database initialization error: {e}")
             raise
 
-    def get_embedding(self, text: str) -> List[float]:
-        """Generate embedding for text using OpenAI."""
-        text = text.replace("\n", " ")
-        return self.client.embeddings.create(input=[text], model="text-embedding-3-large").data[0].embedding
-
-    def add_documents(self, chunks: List[Dict[str, Any]]):
-        """Add chunks to the vector store."""
+    def rebuild_index(self):
+        """Drop and recreate the HNSW index, e.g. after a large bulk load."""
         with self._get_conn() as conn:
             with conn.cursor() as cur:
-                for chunk in chunks:
-                    embedding = self.get_embedding(chunk['text'])
-                    cur.execute("""
-                        INSERT INTO documents (id, content, metadata, embedding)
-                        VALUES (%s, %s, %s, %s)
-                        ON CONFLICT (id) DO UPDATE 
-                        SET content = EXCLUDED.content,
-                            metadata = EXCLUDED.metadata,
-                            embedding = EXCLUDED.embedding;
-                    """, (
-                        chunk['id'],
-                        chunk['text'],
-                        Json(chunk['metadata']),
-                        embedding
-                    ))
+                cur.execute(DROP_HNSW_INDEX_SQL)
+                cur.execute(HNSW_INDEX_SQL)
             conn.commit()
 
+    def get_embedding(self, text: str) -> List[float]:
+        """Generate embedding for text using OpenAI, reusing embeddings of repeated texts."""
+        # Only the cache key is normalized; the original text (case included) is embedded.
+        key = " ".join(text.lower().split())
+        embedding = self._embedding_cache.get(key)
+        if embedding is None:
+            text = text.replace("\n", " ")
+            embedding = self.client.embeddings.create(input=[text], model="text-embedding-3-large").data[0].embedding
+            self._embedding_cache.set(key, embedding)
+        return embedding
+
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts, EMBEDDING_BATCH_SIZE inputs per request."""
+        batches = [
+            [text.replace("\n", " ") for text in texts[start:start + EMBEDDING_BATCH_SIZE]]
+            for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+        ]
+        if not batches:
+            return []
+        return [item.embedding for data in asyncio.run(self._aembed_batches(batches)) for item in data]
+
+    async def _aembed_batches(self, batches: List[List[str]]) -> List[List[Any]]:
+        """Embed batches concurrently; results come back in the same order as `batches`."""
+        # The async client is created per call: its HTTP connections are bound to the
+        # event loop, and asyncio.run starts a fresh loop every time.
+        async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")) as aclient:
+            sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+            async def one(batch: List[str]) -> List[Any]:
+                async with sem:
+                    response = await aclient.embeddings.create(input=batch, model="text-embedding-3-large")
+                    return response.data
+
+            return await asyncio.gather(*[one(batch) for batch in batches])
+
+    def add_documents(self, chunks: List[Dict[str, Any]], replace: bool = False):
+        """
+        Add chunks to the vector store. With `replace`, existing chunks of the same
+        source files are deleted in the same transaction, so a re-upload leaves no
+        stale or duplicate rows (including ones stored under older id schemes).
+        """
+        texts = [chunk['text'] for chunk in chunks]
+        embeddings = self.get_embeddings(texts)
+
+        rebuild = False
+        if len(chunks) >= INDEX_REBUILD_THRESHOLD:
+            with self._get_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT count(*) FROM documents;")
+                    existing = cur.fetchone()[0]
+                    rebuild = existing == 0 or len(chunks) >= existing * INDEX_REBUILD_RATIO
+                    if rebuild:
+                        # Committed on its own so the ACCESS EXCLUSIVE lock isn't held during the load
+                        cur.execute(DROP_HNSW_INDEX_SQL)
+                conn.commit()
+
+        try:
+            with self._get_conn() as conn:
+                with conn.cursor() as cur:
+                    if replace:
+                        sources = list({chunk['metadata']['source'] for chunk in chunks})
+                        cur.execute("DELETE FROM documents WHERE source = ANY(%s)", (sources,))
+                    if len(chunks) >= COPY_THRESHOLD:
+                        self._copy_rows(cur, chunks, embeddings)
+                    else:
+                        rows = [
+                            (chunk['id'], chunk['text'], Json(chunk['metadata']), _vec_literal(embedding))
+                            for chunk, embedding in zip(chunks, embeddings)
+                        ]
+                        execute_values(cur, UPSERT_SQL, rows, template="(%s, %s, %s, %s::halfvec)", page_size=500)
+                conn.commit()
+        finally:
+            # Separate step after the load; searches fall back to a scan until it finishes.
+            # In finally so a failed load never leaves the table without its index.
+            if rebuild:
+                self.rebuild_index()
+
+    def _copy_rows(self, cur, chunks: List[Dict[str, Any]], embeddings: List[List[float]]):
+        """Bulk-load rows with COPY through the staging table."""
+        buf = io.StringIO()
+        for chunk, embedding in zip(chunks, embeddings):
+            buf.write("\t".join((
+                _copy_escape(chunk['id']),
+                _copy_escape(chunk['text']),
+                _copy_escape(json.dumps(chunk['metadata'])),
+                _vec_literal(embedding)
+            )))
+            buf.write("\n")
+        buf.seek(0)
+
+        cur.execute(STAGE_SQL)
+        cur.copy_expert(COPY_SQL, buf)
+        cur.execute(MERGE_SQL)
+
     def delete_document(self, filename: str):
         """Delete all chunks belonging to a specific file."""
         with self._get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("DELETE FROM documents WHERE metadata->>'source' = %s", (filename,))
+                cur.execute("DELETE FROM documents WHERE source = %s", (filename,))
             conn.commit()
 
-    def query(self, query_text: str, limit: int = 5) -> List[Dict[str, Any]]:
-        """Find most similar chunks."""
-        query_embedding = self.get_embedding(query_text)
+    def query(self, query_text: str, limit: int = 5,
+              query_embedding: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+        """Find most similar chunks. Pass `query_embedding` if it has already been computed."""
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query_text)
         
         with self._get_conn() as conn:
             with conn.cursor() as cur:
+                # The embedding is bound once in q (psycopg2 inlines every %s client-side)
                 cur.execute("""
-                    SELECT id, content, metadata, 1 - (embedding <=> %s::vector) as similarity
-                    FROM documents
-                    ORDER BY embedding <=> %s::vector
+                    WITH q AS (SELECT %s::halfvec AS v)
+                    SELECT id, content, metadata, 1 - (embedding <=> q.v) as similarity
+                    FROM documents, q
+                    ORDER BY embedding <=> q.v
                     LIMIT %s;
-                """, (query_embedding, query_embedding, limit))
+                """, (_vec_literal(query_embedding), limit))
                 
                 results = []
                 for row in cur.fetchall():
@@ -94,6 +288,60 @@ class VectorStore:
                     })
                 return results
 
+    def query_with_context(self, query_text: str, limit: int = 5, adjacency_window: int = 1,
+                           query_embedding: Optional[List[float]] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Find most similar chunks and their neighbours in a single round trip.
+        Returns (primary_chunks, context_chunks); each context chunk carries the
+        id of the primary chunk it belongs to in 'neighbor_of'.
+        """
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query_text)
+
+        with self._get_conn() as conn:
+            with conn.cursor() as cur:
+                # Neighbours that are themselves hits are skipped; they are already returned as primaries.
+                # Rows at the hit's own chunk_index (duplicates from older uploads) are not neighbours.
+                cur.execute("""
+                    WITH q AS (SELECT %(embedding)s::halfvec AS v),
+                    hits AS (
+                        SELECT id, content, metadata, 1 - (embedding <=> q.v) AS similarity,
+                               source, chunk_index
+                        FROM documents, q
+                        ORDER BY embedding <=> q.v
+                        LIMIT %(limit)s
+                    )
+                    SELECT id, content, metadata, similarity, NULL AS neighbor_of FROM hits
+                    UNION ALL
+                    SELECT d.id, d.content, d.metadata, NULL, h.id
+                    FROM hits h JOIN documents d
+                      ON d.source = h.source
+                     AND d.chunk_index BETWEEN h.chunk_index - %(window)s AND h.chunk_index + %(window)s
+                     AND d.chunk_index <> h.chunk_index
+                     AND d.id NOT IN (SELECT id FROM hits);
+                """, {"embedding": _vec_literal(query_embedding), "limit": limit, "window": adjacency_window})
+
+                primary_chunks = []
+                context_chunks = []
+                for row in cur.fetchall():
+                    if row[4] is None:
+                        primary_chunks.append({
+                            "id": row[0],
+                            "text": row[1],
+                            "metadata": row[2],
+                            "score": row[3]
+                        })
+                    else:
+                        context_chunks.append({
+                            "id": row[0],
+                            "text": row[1],
+                            "metadata": row[2],
+                            "neighbor_of": row[4]
+                        })
+
+                primary_chunks.sort(key=lambda x: x['score'], reverse=True)
+                return primary_chunks, context_chunks
+
     def get_chunks_by_ids(self, chunk_ids: List[str]) -> List[Dict[str, Any]]:
         """Retrieve specific chunks by ID (used for adjacency)."""
         if not chunk_ids:
@@ -120,5 +368,5 @@ class VectorStore:
         """Get list of all indexed filenames."""
         with self._get_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT DISTINCT metadata->>'source' FROM documents;")
+                cur.execute("SELECT DISTINCT source FROM documents;")
                 return [row[0] for row in cur.fetchall()]